@@ -3,14 +3,15 @@ import os
 import sys
 import logging
 import torch
+import torch.distributed as dist
+import torch.distributed.nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 import time
+from concurrent.futures import ThreadPoolExecutor
 from models import SupResNet
 from dataset import *
 from utils import *
 from loss import *
-import numpy as np
-from sklearn.metrics import r2_score
-from scipy import stats
 
 
 def parse_option():
@@ -20,8 +21,9 @@ def parse_option():
     parser.add_argument('--save_freq', type=int, default=100, help='save frequency')
     parser.add_argument('--save_curr_freq', type=int, default=1, help='save curr last frequency')
 
-    parser.add_argument('--batch_size', type=int, default=128, help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=1, help='num of workers to use')
+    parser.add_argument('--batch_size', type=int, default=128, help='batch_size (global, split evenly across DDP processes)')
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count() or 1), help='num of workers to use')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched per worker')
     parser.add_argument('--epochs', type=int, default=400, help='number of training epochs')
     parser.add_argument('--learning_rate', type=float, default=0.2, help='learning rate')
     parser.add_argument('--lr_decay_rate', type=float, default=0.1, help='decay rate for learning rate')
@@ -36,8 +38,13 @@ def parse_option():
     parser.add_argument('--model', type=str, default='resnet18', choices=['resnet18', 'resnet50'])
     parser.add_argument('--resume', type=str, default='', help='resume ckpt path')
     parser.add_argument('--aug', type=str, default='crop,flip,color,grayscale', help='augmentations')
+    parser.add_argument('--gpu_aug', action='store_true', help='run color augmentations and normalization on the GPU')
+    parser.add_argument('--no_amp', action='store_true', help='disable mixed precision training')
+    parser.add_argument('--no_compile', action='store_true', help='disable torch.compile of the model and loss')
 
     opt = parser.parse_args()
+    # before any filesystem/logging setup, so only rank 0 creates the folder and the log file
+    init_distributed(opt)
 
     opt.model_path = './save/{}_models'.format(opt.dataset)
     opt.model_name = opt.loss+'_{}_{}_ep_{}_lr_{}_d_{}_wd_{}_alpha_{}_mmt_{}_bsz_{}_aug_{}_trial_{}'. \
@@ -47,19 +54,22 @@ def parse_option():
         opt.model_name = opt.resume.split('/')[-2]
 
     opt.save_folder = os.path.join(opt.model_path, opt.model_name)
-    if not os.path.isdir(opt.save_folder):
-        os.makedirs(opt.save_folder)
-    else:
-        print('WARNING: folder exist.')
+    if opt.rank == 0:
+        if not os.path.isdir(opt.save_folder):
+            os.makedirs(opt.save_folder)
+        else:
+            print('WARNING: folder exist.')
+    if opt.distributed:
+        dist.barrier()
 
+    handlers = [logging.StreamHandler()]
+    if opt.rank == 0:
+        handlers.insert(0, logging.FileHandler(os.path.join(opt.save_folder, 'training.log')))
     logging.root.handlers = []
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s | %(message)s",
-        handlers=[
-            logging.FileHandler(os.path.join(opt.save_folder, 'training.log')),
-            logging.StreamHandler()
-        ])
+        handlers=handlers)
 
     print(f"Model name: {opt.model_name}")
     print(f"Options: {opt}")
@@ -67,9 +77,36 @@ def parse_option():
     return opt
 
 
+def init_distributed(opt):
+    # multi-GPU runs are launched with torchrun, which sets LOCAL_RANK/RANK/WORLD_SIZE
+    opt.distributed = 'LOCAL_RANK' in os.environ
+    opt.rank, opt.world_size = 0, 1
+    if not opt.distributed:
+        if torch.cuda.device_count() > 1:
+            print(f'WARNING: {torch.cuda.device_count()} GPUs visible but only one is used; '
+                  f'launch with torchrun --nproc_per_node={torch.cuda.device_count()} to train on all of them.')
+        return
+    dist.init_process_group('nccl')
+    opt.local_rank = int(os.environ['LOCAL_RANK'])
+    opt.rank, opt.world_size = dist.get_rank(), dist.get_world_size()
+    torch.cuda.set_device(opt.local_rank)
+    assert opt.batch_size % opt.world_size == 0, \
+        f'batch_size {opt.batch_size} must be divisible by the number of processes {opt.world_size}'
+    if opt.rank != 0:
+        # only the master rank logs
+        sys.stdout = open(os.devnull, 'w')
+
+
+def gather_batch(*tensors):
+    # GAR, ConR and ranksim use batch statistics, so under DDP they are computed on the batch
+    # gathered from all ranks, as DataParallel did. The autograd all_gather sums the gradients
+    # back onto each rank's slice and DDP averages them, which gives the exact full-batch gradient.
+    return [torch.cat(torch.distributed.nn.functional.all_gather(t), dim=0) for t in tensors]
+
+
 def set_loader(opt):
-    train_transform = get_transforms(split='train', aug=opt.aug)
-    val_transform = get_transforms(split='val', aug=opt.aug)
+    train_transform = get_transforms(split='train', aug=opt.aug, gpu_aug=opt.gpu_aug)
+    val_transform = get_transforms(split='val', aug=opt.aug, gpu_aug=opt.gpu_aug)
     print(f"Train Transforms: {train_transform}")
     print(f"Val Transforms: {val_transform}")
 
@@ -86,19 +123,34 @@ def set_loader(opt):
           f'Val set size: {val_dataset.__len__()}\t'
           f'Test set size: {test_dataset.__len__()}')
 
+    loader_kwargs = dict(num_workers=opt.num_workers, pin_memory=True)
+    if opt.num_workers > 0:
+        # keep workers alive across epochs instead of respawning them every epoch
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=opt.prefetch_factor)
+
+    # under DDP each rank loads its own shard; opt.batch_size stays the global batch size
+    # and the loss is computed on the gathered batch (see gather_batch).
+    # val/test are evaluated in full on every rank so metrics match single-GPU runs.
+    train_sampler = None
+    if opt.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, shuffle=True)
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.num_workers, pin_memory=True
-    )
-    val_loader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers, pin_memory=True
-    )
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers, pin_memory=True
+        train_dataset, batch_size=opt.batch_size // opt.world_size, shuffle=(train_sampler is None),
+        sampler=train_sampler, **loader_kwargs
     )
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=opt.batch_size, shuffle=False, **loader_kwargs)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=opt.batch_size, shuffle=False, **loader_kwargs)
 
     return train_loader, val_loader, test_loader
 
 
+def unwrap_model(model):
+    # the plain SupResNet under DDP and torch.compile; it shares parameters with the wrapped model
+    if isinstance(model, DDP):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
 def set_model(opt):
     model = SupResNet(name=opt.model, num_classes=get_label_dim(opt.dataset))
     if opt.loss in ['GAR', 'GAR-EXP']:
@@ -111,54 +163,90 @@ def set_model(opt):
         criterion = torch.nn.L1Loss()
 
     if torch.cuda.is_available():
-        if torch.cuda.device_count() > 1:
-            model.encoder = torch.nn.DataParallel(model.encoder)
-        model = model.cuda()
+        # NHWC lets cuDNN pick its tensor-core convolution kernels
+        model = model.cuda().to(memory_format=torch.channels_last)
         criterion = criterion.cuda()
         torch.backends.cudnn.benchmark = True
-
-    return model, criterion
-
-
-def train(train_loader, model, criterion, optimizer, epoch, opt):
+        # allow TF32 for the fp32 matmuls/convs left outside autocast (fc head, losses, --no_amp)
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
+
+    use_compile = torch.cuda.is_available() and not opt.no_compile
+    if use_compile and not hasattr(torch, 'compile'):
+        print(f'WARNING: torch {torch.__version__} has no torch.compile, running the model and loss uncompiled.')
+        use_compile = False
+
+    if use_compile:
+        # checkpoints are taken from unwrap_model(model), so the '_orig_mod.' prefix never reaches them
+        model = torch.compile(model, mode='max-autotune')
+    if opt.distributed:
+        model = DDP(model, device_ids=[opt.local_rank])
+
+    # resolve the loss once here instead of dispatching on opt.loss every iteration
+    loss_fns = {
+        'ConR': lambda output, feat, labels: criterion(output, labels) + opt.alpha*ConR(feat, labels, output),
+        'ranksim': lambda output, feat, labels: criterion(output, labels) + batchwise_ranking_regularizer(feat, labels, opt.alpha),
+        'focal-mae': lambda output, feat, labels: weighted_focal_mae_loss(output, labels, beta=opt.alpha),
+        'focal-mse': lambda output, feat, labels: weighted_focal_mse_loss(output, labels, beta=opt.alpha),
+    }
+    loss_fn = loss_fns.get(opt.loss, lambda output, feat, labels: criterion(output, labels))
+    # fuse the elementwise/reduction chain of the pure tensor losses (GAR, MSE/Huber/L1, focal);
+    # their shapes only change for the shorter last batch, which costs a single recompile.
+    # ConR unrolls a per-sample python loop into the graph and ranksim works on a data-dependent
+    # subset of the batch (torch.unique), so both would recompile constantly and stay eager.
+    if use_compile and opt.loss not in ['ConR', 'ranksim']:
+        loss_fn = torch.compile(loss_fn, fullgraph=False, dynamic=False)
+
+    return model, loss_fn
+
+
+def train(train_loader, model, loss_fn, optimizer, scaler, epoch, opt, device, gpu_transform=None):
     model.train()
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
 
-    end = time.time()
+    if device.type == 'cuda':
+        train_loader = CUDAPrefetcher(train_loader)
+
+    # the host only syncs with the GPU once every print_freq steps, when the loss is read back;
+    # batch time is measured over that window, after the sync, so it reflects the GPU work
+    loss_sum, n = 0., 0
+    window_start = end = time.time()
     for idx, (images, labels) in enumerate(train_loader):
         data_time.update(time.time() - end)
         bsz = labels.shape[0]
 
         images = torch.cat([images[0], images[1]], dim=0)
         labels = labels.repeat(2, 1)  # [2bs, label_dim]
-        if torch.cuda.is_available():
-            images = images.cuda(non_blocking=True)
-            labels = labels.cuda(non_blocking=True)
-
-        output, feat = model(images)
-        if opt.loss == 'ConR':
-            loss = criterion(output, labels) + opt.alpha*ConR(feat, labels, output)
-        elif opt.loss == 'ranksim':
-            loss = criterion(output, labels) + batchwise_ranking_regularizer(feat, labels, opt.alpha)
-        elif opt.loss == 'focal-mae':
-            loss = weighted_focal_mae_loss(output, labels, beta=opt.alpha)
-        elif opt.loss == 'focal-mse':
-            loss = weighted_focal_mse_loss(output, labels, beta=opt.alpha)
-        else:
-            loss = criterion(output, labels)
-        losses.update(loss.item(), bsz)
+        if gpu_transform is not None:
+            images = gpu_transform(images)
+        images = images.contiguous(memory_format=torch.channels_last)
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        with torch.cuda.amp.autocast(enabled=opt.amp, dtype=opt.amp_dtype):
+            output, feat = model(images)
+        # losses are computed in fp32 for numerical stability
+        output, feat = output.float(), feat.float()
+        if opt.distributed:
+            output, feat, labels = gather_batch(output, feat, labels)
+        loss = loss_fn(output, feat, labels)
+        loss_sum = loss_sum + loss.detach() * bsz
+        n += bsz
+
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        batch_time.update(time.time() - end)
         end = time.time()
 
         if (idx + 1) % opt.print_freq == 0:
+            losses.update((loss_sum / n).item(), n)
+            loss_sum, n = 0., 0
+            end = time.time()
+            batch_time.update((end - window_start) / opt.print_freq, opt.print_freq)
+            window_start = end
             to_print = 'Train: [{0}][{1}/{2}]\t'\
                        'BT {batch_time.val:.3f} ({batch_time.avg:.3f})\t'\
                        'DT {data_time.val:.3f} ({data_time.avg:.3f})\t'\
@@ -170,47 +258,79 @@ def train(train_loader, model, criterion, optimizer, epoch, opt):
             sys.stdout.flush()
 
 
-def validate(val_loader, model):
+def validate(val_loader, model, device, gpu_transform=None):
     model.eval()
 
-    pred = []
-    truth = [] 
-    with torch.no_grad():
+    # predictions stay on the device; only the final metrics are copied back to the host
+    n = len(val_loader.dataset)
+    pred, truth = None, None
+    offset = 0
+    with torch.inference_mode():
         for idx, (images, labels) in enumerate(val_loader):
-            images = images.cuda()
-            labels = labels.cuda()
+            images = images.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            if gpu_transform is not None:
+                images = gpu_transform(images)
+            images = images.contiguous(memory_format=torch.channels_last)
+            bsz = labels.shape[0]
 
             output, feat = model(images)
 
-            pred.append(output.cpu().detach().numpy())
-            truth.append(labels.cpu().detach().numpy())
-    pred = np.concatenate(pred, axis=0)
-    truth = np.concatenate(truth, axis=0)
-    va_MAE = np.abs(pred-truth).mean()
-    va_RMSE = ((pred-truth)**2).mean()**0.5
-    va_pear = np.corrcoef(truth, pred, rowvar=False)[0,1]
-    va_spear = stats.spearmanr(truth, pred)[0]
-    va_R2 = r2_score(truth, pred)
-    return [va_MAE, va_RMSE, va_pear, va_spear, va_R2]
+            if pred is None:
+                pred = torch.empty((n, output.shape[1]), dtype=torch.float32, device=output.device)
+                truth = torch.empty_like(pred)
+            pred[offset:offset+bsz].copy_(output)
+            truth[offset:offset+bsz].copy_(labels)
+            offset += bsz
+        pred, truth = pred.double(), truth.double()
+        diff = pred - truth
+        both = torch.cat([truth, pred], dim=1)
+        va_MAE = diff.abs().mean()
+        va_RMSE = diff.pow(2).mean().sqrt()
+        va_pear = torch.corrcoef(both.T)[0,1]
+        # spearman is the pearson correlation of (tie-averaged) ranks, as in scipy.stats.spearmanr
+        va_spear = torch.corrcoef(torch.stack([average_rank(col) for col in both.T]))[0,1]
+        # r2 averaged uniformly over label dims, as sklearn's r2_score does
+        va_R2 = (1 - diff.pow(2).sum(0) / (truth - truth.mean(0)).pow(2).sum(0)).mean()
+        # a single device-to-host copy for all metrics
+        return torch.stack([va_MAE, va_RMSE, va_pear, va_spear, va_R2]).tolist()
 
 
 def main():
     opt = parse_option()
+    # under DDP the current CUDA device has been set to this rank's GPU
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     # build data loader
     train_loader, val_loader, test_loader = set_loader(opt)
 
-    # build model and criterion
-    model, criterion = set_model(opt)
+    # color augmentations and normalization done on the GPU with --gpu_aug
+    train_gpu_transform, val_gpu_transform = None, None
+    if opt.gpu_aug:
+        train_gpu_transform = get_gpu_transforms(split='train', aug=opt.aug)
+        val_gpu_transform = get_gpu_transforms(split='val', aug=opt.aug)
+
+    # build model and loss
+    model, loss_fn = set_model(opt)
+    # checkpoints hold the unwrapped model so they load with or without DDP/compile
+    model_without_ddp = unwrap_model(model)
 
     # build optimizer
     optimizer = set_optimizer(opt, model)
 
+    # mixed precision: bf16 where supported, otherwise fp16 with loss scaling
+    opt.amp = not opt.no_amp and torch.cuda.is_available()
+    opt.amp_dtype = torch.bfloat16 if opt.amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=opt.amp and opt.amp_dtype == torch.float16)
+
     start_epoch = 1
     if len(opt.resume):
-        ckpt_state = torch.load(opt.resume)
-        model.load_state_dict(ckpt_state['model'])
+        ckpt_state = torch.load(opt.resume, map_location='cpu')
+        model_without_ddp.load_state_dict(ckpt_state['model'])
         optimizer.load_state_dict(ckpt_state['optimizer'])
+        # bf16/--no_amp runs store no loss scale; a fresh scaler then starts from its default
+        if ckpt_state.get('scaler') and scaler.is_enabled():
+            scaler.load_state_dict(ckpt_state['scaler'])
         start_epoch = ckpt_state['epoch'] + 1
         print(f"<=== Epoch [{ckpt_state['epoch']}] Resumed from {opt.resume}!")
 
@@ -218,28 +338,37 @@ def main():
     best_test = [best_error, best_error, best_error, best_error, best_error]
     save_file_best = os.path.join(opt.save_folder, 'best.pth')
 
+    # checkpoints are written by a background thread so the training loop does not wait on disk
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
+
     # training routine
     for epoch in range(start_epoch, opt.epochs + 1):
         adjust_learning_rate(opt, optimizer, epoch)
+        if opt.distributed:
+            train_loader.sampler.set_epoch(epoch)
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, opt)
+        train(train_loader, model, loss_fn, optimizer, scaler, epoch, opt, device, train_gpu_transform)
 
-        valid_error = validate(val_loader, model)
+        valid_error = validate(val_loader, model, device, val_gpu_transform)
         print(valid_error)
         print('valid_MAE={:.3f}, valid_RMSE={:.3f}, valid_Pearson={:.3f}, valid_Spearman={:.3f}, valid_R2={:.3f}'.format(*valid_error))
 
         is_best = valid_error[0] < best_error
         best_error = min(valid_error[0], best_error)
         print(f"Best Error: {best_error:.3f}")
-    
-        test_error = validate(test_loader, model)
-        print('test_MAE={:.3f}, test_RMSE={:.3f}, test_Pearson={:.3f}, test_Spearman={:.3f}, test_R2={:.3f}'.format(*test_error))
 
-        if epoch % opt.save_freq == 0:
+        # only the test metrics of the best-on-validation model are reported, so skip the
+        # test pass on epochs where validation did not improve
+        if is_best:
+            test_error = validate(test_loader, model, device, val_gpu_transform)
+            print('test_MAE={:.3f}, test_RMSE={:.3f}, test_Pearson={:.3f}, test_Spearman={:.3f}, test_R2={:.3f}'.format(*test_error))
+
+        if epoch % opt.save_freq == 0 and opt.rank == 0:
             save_file = os.path.join(
                 opt.save_folder, 'ckpt_epoch_{epoch}.pth'.format(epoch=epoch))
-            save_model(model, optimizer, opt, epoch, save_file)
+            pending_saves.append(save_model(model_without_ddp, optimizer, opt, epoch, save_file, save_executor, scaler))
 
         #if epoch % opt.save_curr_freq == 0:
         #    save_file = os.path.join(
@@ -248,11 +377,12 @@ def main():
 
         if is_best:
             best_test = test_error
-            torch.save({
-                'epoch': epoch,
-                'model': model.state_dict(),
-                'best_error': best_error
-            }, save_file_best)
+            if opt.rank == 0:
+                pending_saves.append(save_state({
+                    'epoch': epoch,
+                    'model': model_without_ddp.state_dict(),
+                    'best_error': best_error
+                }, save_file_best, save_executor))
         print('Best test_MAE={:.3f}, test_RMSE={:.3f}, test_Pearson={:.3f}, test_Spearman={:.3f}, test_R2={:.3f}'.format(*best_test))
 
     #print("=" * 120)
@@ -263,6 +393,14 @@ def main():
     #test_error = validate(test_loader, model)
     #print('test_MAE={:.3f}, test_RMSE={:.3f}, test_Pearson={:.3f}, test_Spearman={:.3f}, test_R2={:.3f}'.format(test_error))
 
+    # wait for outstanding checkpoints and surface any write errors
+    save_executor.shutdown(wait=True)
+    for future in pending_saves:
+        future.result()
+
+    if opt.distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
     main()
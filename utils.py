@@ -16,7 +16,9 @@ class TwoCropTransform:
         return [self.transform(x), self.transform(x)]
 
 
-def get_transforms(split, aug):
+def get_transforms(split, aug, gpu_aug=False):
+    # with gpu_aug only decoding and geometric augmentations run here and uint8 tensors are
+    # returned; color augmentations and normalization are done by get_gpu_transforms
     normalize = transforms.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
     if split == 'train':
         aug_list = aug.split(',')
@@ -31,6 +33,10 @@ def get_transforms(split, aug):
         if 'flip' in aug_list:
             transforms_list.append(transforms.RandomHorizontalFlip())
 
+        if gpu_aug:
+            transforms_list.append(transforms.PILToTensor())
+            return transforms.Compose(transforms_list)
+
         if 'color' in aug_list:
             transforms_list.append(transforms.RandomApply([
                 transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
@@ -42,6 +48,12 @@ def get_transforms(split, aug):
         transforms_list.append(transforms.ToTensor())
         transforms_list.append(normalize)
         transform = transforms.Compose(transforms_list)
+    elif gpu_aug:
+        transform = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.PILToTensor(),
+        ])
     else:
         transform = transforms.Compose([
             transforms.Resize(256),
@@ -53,6 +65,93 @@ def get_transforms(split, aug):
     return transform
 
 
+def get_gpu_transforms(split, aug):
+    aug_list = aug.split(',') if split == 'train' else []
+    return GPUColorTransform(color='color' in aug_list, grayscale='grayscale' in aug_list)
+
+
+def _rgb_to_grayscale(x):
+    return (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=1)
+    maxc = x.max(dim=1).values
+    minc = x.min(dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return h, s, maxc
+
+
+def _hsv_to_rgb(h, s, v):
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int32) % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    mask = (i.unsqueeze(1) == torch.arange(6, device=i.device).view(-1, 1, 1)).to(v.dtype)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    return torch.einsum('...ijk, ...xijk -> ...xjk', mask, torch.stack((a1, a2, a3), dim=1))
+
+
+class GPUColorTransform(torch.nn.Module):
+    # batched counterpart of the color part of get_transforms: takes uint8 [bs, 3, H, W] images,
+    # applies RandomApply(ColorJitter(0.4, 0.4, 0.4, 0.1), p=0.8) and RandomGrayscale(p=0.2) with
+    # independent random factors per image, then ToTensor scaling and normalization.
+    # Unlike torchvision, the order of the jitter ops is shuffled per batch instead of per image.
+    def __init__(self, color=False, grayscale=False, mean=0.5, std=0.5):
+        super().__init__()
+        self.color = color
+        self.grayscale = grayscale
+        self.brightness, self.contrast, self.saturation, self.hue = 0.4, 0.4, 0.4, 0.1
+        self.mean, self.std = mean, std
+
+    def _factor(self, x, lo, hi):
+        return torch.empty(x.shape[0], 1, 1, 1, device=x.device).uniform_(lo, hi)
+
+    def _color_jitter(self, x):
+        for op in torch.randperm(4).tolist():
+            if op == 0:
+                f = self._factor(x, 1 - self.brightness, 1 + self.brightness)
+                x = (x * f).clamp(0.0, 1.0)
+            elif op == 1:
+                f = self._factor(x, 1 - self.contrast, 1 + self.contrast)
+                mean = _rgb_to_grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+                x = (f * x + (1 - f) * mean).clamp(0.0, 1.0)
+            elif op == 2:
+                f = self._factor(x, 1 - self.saturation, 1 + self.saturation)
+                x = (f * x + (1 - f) * _rgb_to_grayscale(x)).clamp(0.0, 1.0)
+            else:
+                f = self._factor(x, -self.hue, self.hue).view(-1, 1, 1)
+                h, s, v = _rgb_to_hsv(x)
+                x = _hsv_to_rgb(torch.remainder(h + f, 1.0), s, v)
+        return x
+
+    @torch.no_grad()
+    def forward(self, x):
+        x = x.float().div_(255)
+        if self.color:
+            apply = torch.rand(x.shape[0], 1, 1, 1, device=x.device) < 0.8
+            x = torch.where(apply, self._color_jitter(x), x)
+        if self.grayscale:
+            apply = torch.rand(x.shape[0], 1, 1, 1, device=x.device) < 0.2
+            x = torch.where(apply, _rgb_to_grayscale(x).expand_as(x), x)
+        return (x - self.mean) / self.std
+
+
 def get_label_dim(dataset):
     if dataset in ['AgeDB']:
         label_dim = 1
@@ -78,6 +177,48 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class CUDAPrefetcher(object):
+    # copies batch N+1 to the GPU on a side stream while batch N is being computed
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_cuda(self, x):
+        if isinstance(x, (list, tuple)):
+            return [self._to_cuda(t) for t in x]
+        return x.cuda(non_blocking=True)
+
+    def _record_stream(self, x, stream):
+        if isinstance(x, (list, tuple)):
+            for t in x:
+                self._record_stream(t, stream)
+        else:
+            x.record_stream(stream)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_cuda(batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_stream(self.stream)
+            # the tensors were allocated on the copy stream but are consumed on the compute stream
+            self._record_stream(batch, stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+
 def adjust_learning_rate(args, optimizer, epoch):
     lr = args.learning_rate
     eta_min = lr * (args.lr_decay_rate ** 3)
@@ -86,7 +227,35 @@ def adjust_learning_rate(args, optimizer, epoch):
         param_group['lr'] = lr
 
 
-def save_model(model, optimizer, opt, epoch, save_file):
+def average_rank(x):
+    # 1-based ranks of a 1-D tensor with ties given their average rank (scipy.stats.rankdata)
+    sorted_x, order = x.sort()
+    _, inverse, counts = torch.unique_consecutive(sorted_x, return_inverse=True, return_counts=True)
+    avg = counts.cumsum(0) - (counts - 1) / 2.0
+    ranks = torch.empty_like(x)
+    ranks[order] = avg[inverse].to(x.dtype)
+    return ranks
+
+
+def state_to_cpu(state):
+    # host copy of a (nested) state dict that training can no longer modify in place
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+def save_state(state, save_file, executor=None):
+    # with an executor the state is snapshotted to the host here and written out in the background
+    if executor is not None:
+        return executor.submit(torch.save, state_to_cpu(state), save_file)
+    torch.save(state, save_file)
+
+
+def save_model(model, optimizer, opt, epoch, save_file, executor=None, scaler=None):
     print('==> Saving...')
     state = {
         'opt': opt,
@@ -94,14 +263,17 @@ def save_model(model, optimizer, opt, epoch, save_file):
         'optimizer': optimizer.state_dict(),
         'epoch': epoch,
     }
-    torch.save(state, save_file)
-    del state
+    if scaler is not None and scaler.is_enabled():
+        # keeps the fp16 loss scale across resumes
+        state['scaler'] = scaler.state_dict()
+    return save_state(state, save_file, executor)
 
 
 
 def set_optimizer(opt, model):
+    # foreach updates all parameters with a handful of multi-tensor kernels instead of one launch per tensor
     optimizer = torch.optim.SGD(model.parameters(), lr=opt.learning_rate,
-                                momentum=opt.momentum, weight_decay=opt.weight_decay)
+                                momentum=opt.momentum, weight_decay=opt.weight_decay, foreach=True)
 
     return optimizer
 